@@ -1,14 +1,8 @@
 '''
 Schema of aquisition information.
 '''
-import re
-import os
-from datetime import datetime
 
-import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
 from . import reference, subject, utilities
 
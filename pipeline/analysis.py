@@ -2,14 +2,9 @@
 '''
 Schema of analysis data.
 '''
-import re
-import os
-from datetime import datetime
 
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
 from . import reference, utilities, acquisition
 
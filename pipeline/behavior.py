@@ -1,14 +1,10 @@
 '''
 Schema of behavioral information.
 '''
-import re
 import os
-from datetime import datetime
 import pathlib
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
 from . import reference, subject, utilities, stimulation, acquisition, analysis
 
@@ -37,16 +33,16 @@ class LickTrace(dj.Imported):
         # Search the files in filenames to find a match for "this" session (based on key)
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
-            raise FileNotFoundError(f'BehaviorAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
-        #  ============= Now read the data and start ingesting =============
-        print('Insert behavioral data for: subject: {0} - date: {1}'.format(key['subject_id'], key['session_time']))
-        key['lick_trace_left'] = nwb['acquisition']['timeseries']['lick_trace_L']['data'].value
-        key['lick_trace_right'] = nwb['acquisition']['timeseries']['lick_trace_R']['data'].value
-        lick_trace_time_stamps = nwb['acquisition']['timeseries']['lick_trace_R']['timestamps'].value
-        key['lick_trace_start_time'] = lick_trace_time_stamps[0]
-        key['lick_trace_sampling_rate'] = 1 / np.mean(np.diff(lick_trace_time_stamps))
-        self.insert1(key)
+            raise FileNotFoundError(f'LickTrace import failed for: {animal_id} - {date_of_experiment}')
+        with utilities.open_nwbfile(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            #  ============= Now read the data and start ingesting =============
+            print('Insert behavioral data for: subject: {0} - date: {1}'.format(key['subject_id'], key['session_time']))
+            key['lick_trace_left'] = utilities.read_dataset(nwb['acquisition']['timeseries']['lick_trace_L']['data'])
+            key['lick_trace_right'] = utilities.read_dataset(nwb['acquisition']['timeseries']['lick_trace_R']['data'])
+            lick_trace_time_stamps = utilities.read_dataset(nwb['acquisition']['timeseries']['lick_trace_R']['timestamps'])
+            key['lick_trace_start_time'] = lick_trace_time_stamps[0]
+            key['lick_trace_sampling_rate'] = 1 / np.mean(np.diff(lick_trace_time_stamps))
+            self.insert1(key)
 
 
 @schema
@@ -3,12 +3,9 @@ Schema of extracellular information.
 '''
 import re
 import os
-from datetime import datetime
 import pathlib
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 import tqdm
 
 from . import reference, utilities, acquisition, analysis
@@ -17,6 +14,8 @@ schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'extracellul
 
 sess_data_dir = pathlib.Path(dj.config['custom'].get('extracellular_directory')).as_posix()
 
+_UNIT_RE = re.compile('\d+')
+
 
 @schema
 class ProbeInsertion(dj.Manual):
@@ -67,32 +66,24 @@ class UnitSpikeTimes(dj.Imported):
         if sess_data_file is None:
             print(f'UnitSpikeTimes import failed for: {animal_id} - {date_of_experiment}')
             return
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
-        # ------ Spike ------
-        ec_event_waveform = nwb['processing']['extracellular_units']['EventWaveform']
-        ec_unit_times = nwb['processing']['extracellular_units']['UnitTimes']
-        # - unit cell type
-        cell_type = {}
-        for tmp_str in ec_unit_times.get('cell_types').value:
-            tmp_str = tmp_str.decode('UTF-8')
-            split_str = re.split(' - ', tmp_str)
-            cell_type[split_str[0]] = split_str[1]
-        # - unit info
-        # print('Inserting spike unit: ', end = "")
-        for unit_str in tqdm.tqdm(ec_event_waveform.keys()):
-            unit_id = int(re.search('\d+', unit_str).group())
-            unit_depth = ec_unit_times.get(unit_str).get('depth').value
-            key['unit_id'] = unit_id
-            key['channel_id'] = ec_event_waveform.get(unit_str).get('electrode_idx').value.item(
-                0) - 1  # TODO: check if electrode_idx has MATLAB 1-based indexing (starts at 1)
-            key['spike_times'] = ec_unit_times.get(unit_str).get('times').value
-            key['unit_cell_type'] = cell_type[unit_str]
-            key.update(zip(('unit_x', 'unit_y', 'unit_z'), unit_depth))
-            key['spike_waveform'] = ec_event_waveform.get(unit_str).get('data').value
-            self.insert1(key)
-        #     print(f'{unit_id} ', end = "")
-        # print('')
-        nwb.close()
+        with utilities.open_nwbfile(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            # ------ Spike ------
+            ec_event_waveform = nwb['processing']['extracellular_units']['EventWaveform']
+            ec_unit_times = nwb['processing']['extracellular_units']['UnitTimes']
+            # - unit cell type
+            cell_types = np.char.partition(utilities.read_str(ec_unit_times.get('cell_types')), ' - ')
+            cell_type = dict(zip(cell_types[:, 0], cell_types[:, 2]))
+            # - unit info - one insert per unit, as spike times/waveforms are large longblobs
+            for unit_str in tqdm.tqdm(ec_event_waveform.keys()):
+                unit_depth = ec_unit_times.get(unit_str).get('depth')[()]
+                self.insert1(dict(key,
+                                  unit_id=int(_UNIT_RE.search(unit_str).group()),
+                                  channel_id=ec_event_waveform.get(unit_str).get('electrode_idx')[()].item(
+                                      0) - 1,  # TODO: check if electrode_idx has MATLAB 1-based indexing (starts at 1)
+                                  spike_times=utilities.read_dataset(ec_unit_times.get(unit_str).get('times')),
+                                  unit_cell_type=cell_type[unit_str],
+                                  spike_waveform=utilities.read_dataset(ec_event_waveform.get(unit_str).get('data')),
+                                  **dict(zip(('unit_x', 'unit_y', 'unit_z'), unit_depth))))
 
 
 @schema
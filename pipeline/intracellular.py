@@ -6,7 +6,6 @@ import os
 import pathlib
 import numpy as np
 import datajoint as dj
-import h5py as h5
 
 from . import reference, utilities, acquisition, analysis
 
@@ -46,24 +45,23 @@ class MembranePotential(dj.Imported):
         # Search the files in filenames to find a match for "this" session (based on key)
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
-            raise FileNotFoundError(f'IntracellularAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
-        #  ============= Now read the data and start ingesting =============
-        print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
-                                                                                           key['session_time'],
-                                                                                           key['cell_id']))
-        # -- MembranePotential
-        membrane_potential_time_stamps = nwb['acquisition']['timeseries']['membrane_potential']['timestamps'].value
-        self.insert1(dict(key,
-                          membrane_potential=nwb['acquisition']['timeseries']['membrane_potential'][
-                              'data'].value,
-                          membrane_potential_wo_spike=
-                          nwb['analysis']['Vm_wo_spikes']['membrane_potential_wo_spike'][
-                              'data'].value,
-                          membrane_potential_start_time=membrane_potential_time_stamps[0],
-                          membrane_potential_sampling_rate=1 / np.mean(
-                              np.diff(membrane_potential_time_stamps))))
-        nwb.close()
+            raise FileNotFoundError(f'MembranePotential import failed for: {animal_id} - {date_of_experiment}')
+        with utilities.open_nwbfile(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            #  ============= Now read the data and start ingesting =============
+            print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
+                                                                                               key['session_time'],
+                                                                                               key['cell_id']))
+            # -- MembranePotential
+            membrane_potential_time_stamps = utilities.read_dataset(
+                nwb['acquisition']['timeseries']['membrane_potential']['timestamps'])
+            self.insert1(dict(key,
+                              membrane_potential=utilities.read_dataset(
+                                  nwb['acquisition']['timeseries']['membrane_potential']['data']),
+                              membrane_potential_wo_spike=utilities.read_dataset(
+                                  nwb['analysis']['Vm_wo_spikes']['membrane_potential_wo_spike']['data']),
+                              membrane_potential_start_time=membrane_potential_time_stamps[0],
+                              membrane_potential_sampling_rate=1 / np.mean(
+                                  np.diff(membrane_potential_time_stamps))))
 
 
 @schema
@@ -84,21 +82,21 @@ class CurrentInjection(dj.Imported):
         # Search the files in filenames to find a match for "this" session (based on key)
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
-            raise FileNotFoundError(f'IntracellularAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
-        #  ============= Now read the data and start ingesting =============
-        print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
-                                                                                           key['session_time'],
-                                                                                           key['cell_id']))
-        # -- CurrentInjection
-        current_injection_time_stamps = nwb['acquisition']['timeseries']['current_injection']['timestamps'].value
-        self.insert1(dict(key,
-                                           current_injection = nwb['acquisition']['timeseries']['current_injection'][
-                                               'data'].value,
-                                           current_injection_start_time = current_injection_time_stamps[0],
-                                           current_injection_sampling_rate = 1 / np.mean(
-                                               np.diff(current_injection_time_stamps))))
-        nwb.close()
+            raise FileNotFoundError(f'CurrentInjection import failed for: {animal_id} - {date_of_experiment}')
+        with utilities.open_nwbfile(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            #  ============= Now read the data and start ingesting =============
+            print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
+                                                                                               key['session_time'],
+                                                                                               key['cell_id']))
+            # -- CurrentInjection
+            current_injection_time_stamps = utilities.read_dataset(
+                nwb['acquisition']['timeseries']['current_injection']['timestamps'])
+            self.insert1(dict(key,
+                                               current_injection = utilities.read_dataset(
+                                                   nwb['acquisition']['timeseries']['current_injection']['data']),
+                                               current_injection_start_time = current_injection_time_stamps[0],
+                                               current_injection_sampling_rate = 1 / np.mean(
+                                                   np.diff(current_injection_time_stamps))))
 
 
 @schema
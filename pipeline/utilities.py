@@ -1,6 +1,8 @@
 import os
+import functools
 from datetime import datetime
 import re
+import numpy as np
 import h5py as h5
 
 
@@ -9,6 +11,14 @@ datetimeformat_ymdhms = '%Y-%m-%d %H:%M:%S'
 datetimeformat_ymd = '%Y-%m-%d'
 
 
+def open_nwbfile(path):
+    """
+    Open the NWB (HDF5) file at `path` read-only, with a larger raw-data chunk cache (16 MB)
+    so chunks touched by both metadata and data reads are decompressed only once
+    """
+    return h5.File(path, 'r', libver='latest', rdcc_nbytes=16 * 1024 * 1024, rdcc_nslots=10007)
+
+
 def parse_prefix(line):
     cover = len(datetime.now().strftime(datetimeformat_ymdhms))
     try:
@@ -23,37 +33,107 @@ def parse_prefix(line):
             return None    
 
 
-def find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment):
-    ############## Dataset #################
+@functools.lru_cache(maxsize=8)
+def _list_nwbfiles(sess_data_dir, dir_mtime):
+    """
+    List the NWB files in `sess_data_dir` - `dir_mtime` is part of the cache key so the listing is refreshed
+    whenever files are added to or removed from the directory
+    """
+    return tuple(sorted(e.name for e in os.scandir(sess_data_dir) if e.is_file() and e.name.endswith('.nwb')))
 
-    sess_data_files = os.listdir(sess_data_dir)
+
+def _read_session_identity(sess_data_dir, sess_data_file):
+    """
+    Read (subject_id, session_start_time) out of the NWB file `sess_data_file`, or None if it cannot be opened
+    """
     which_data = re.search('extracellular|whole_cell', sess_data_dir).group()
-    # Search the filenames to find a match for "this" session (based on key)
-    sess_data_file = None
-    for s in sess_data_files:
-        try:
-            temp_nwb = h5.File(os.path.join(sess_data_dir, s), 'r')
-        except:
-            print(f'!!! error load file: {s}')
-            continue
+    try:
+        temp_nwb = open_nwbfile(os.path.join(sess_data_dir, sess_data_file))
+    except:
+        print(f'!!! error load file: {sess_data_file}')
+        return None
+    with temp_nwb:
         # read subject_id out of this file
-        subject_id = temp_nwb['general']['subject']['subject_id'].value.decode('UTF-8').lower()
+        subject_id = read_str(temp_nwb['general']['subject']['subject_id']).lower()
 
         # -- session_time - due to error in extracellular dataset (session_start_time error), need to hard code here...
         if which_data == 'whole_cell':  # case: whole cell
-            session_start_time = temp_nwb['session_start_time'].value
+            session_start_time = read_str(temp_nwb['session_start_time'])
             session_start_time = parse_prefix(session_start_time)
         elif which_data == 'extracellular':# case: extracellular
-            identifier = temp_nwb['identifier'].value
+            identifier = read_str(temp_nwb['identifier'])
             session_start_time = re.split(';\s?', identifier)[-1].replace('T', ' ')
             session_start_time = parse_prefix(session_start_time)
+    return subject_id, session_start_time
+
+
+# sess_data_dir -> {'dir_mtime': ..., 'files': {filename: (file_mtime, (subject_id, session_start_time) or None)},
+#                   'index': {(subject_id, session_start_time): filename}}
+_session_indices = {}
+
+
+def _read_into_session_index(sess_data_dir, entry, sess_data_files):
+    """
+    (Re)read the session identity of `sess_data_files` into the cached `entry`, then rebuild its lookup index
+    Files that cannot be read are recorded with a None identity, to be retried on a lookup miss
+    """
+    for s in sess_data_files:
+        file_mtime = os.stat(os.path.join(sess_data_dir, s)).st_mtime
+        entry['files'][s] = (file_mtime, _read_session_identity(sess_data_dir, s))
+    entry['index'] = {}
+    for s in sorted(entry['files']):
+        session_identity = entry['files'][s][1]
+        if session_identity is not None:
+            entry['index'].setdefault(session_identity, s)
+
+
+def _build_session_index(sess_data_dir, dir_mtime):
+    """
+    Map (subject_id, session_start_time) of each NWB file in `sess_data_dir` to its filename
+    Each file is opened once - only files added since the last call (directory mtime changed) are read
+    """
+    entry = _session_indices.setdefault(sess_data_dir, {'dir_mtime': None, 'files': {}, 'index': {}})
+    if entry['dir_mtime'] != dir_mtime:
+        sess_data_files = _list_nwbfiles(sess_data_dir, dir_mtime)
+        for s in set(entry['files']) - set(sess_data_files):  # removed files
+            del entry['files'][s]
+        _read_into_session_index(sess_data_dir, entry, [s for s in sess_data_files if s not in entry['files']])
+        entry['dir_mtime'] = dir_mtime
+    return entry['index']
 
-        # compare key with extracted info from this file
-        if (animal_id == subject_id) and (date_of_experiment == session_start_time):
-            # if true, meaning the current "nwb" variable is a match with this session
-            sess_data_file = s
-            break
-        temp_nwb.close()
+
+def _refresh_session_index(sess_data_dir):
+    """
+    Retry the files of `sess_data_dir` that could not be read before, or whose content changed since they were read
+    """
+    entry = _session_indices[sess_data_dir]
+    stale_files = [s for s, (file_mtime, session_identity) in entry['files'].items()
+                   if session_identity is None or os.stat(os.path.join(sess_data_dir, s)).st_mtime != file_mtime]
+    if stale_files:
+        _read_into_session_index(sess_data_dir, entry, stale_files)
+    return entry['index']
+
+
+def find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment):
+    ############## Dataset #################
+    dir_mtime = os.stat(sess_data_dir).st_mtime
+    sess_data_files = _list_nwbfiles(sess_data_dir, dir_mtime)
+
+    # Filenames usually carry the subject and date (e.g. anm322808_2017-05-20_19-29-10.nwb, or undashed 20170520)
+    # - check those few candidates before indexing the whole directory
+    date_strs = (date_of_experiment.strftime('%Y-%m-%d'), date_of_experiment.strftime('%Y%m%d'))
+    candidates = (s for s in sess_data_files
+                  if animal_id in s.lower() and any(date_str in s for date_str in date_strs))
+    sess_data_file = next((s for s in candidates
+                           if _read_session_identity(sess_data_dir, s) == (animal_id, date_of_experiment)), None)
+
+    # Otherwise, search the filenames to find a match for "this" session (based on key)
+    if sess_data_file is None:
+        sess_data_file = _build_session_index(sess_data_dir, dir_mtime).get((animal_id, date_of_experiment))
+    # Unreadable files (e.g. still being copied) or changed file contents do not touch the directory mtime -
+    # retry just those files before reporting a miss
+    if sess_data_file is None:
+        sess_data_file = _refresh_session_index(sess_data_dir).get((animal_id, date_of_experiment))
 
     # If session not found from dataset, break
     if sess_data_file is None:
@@ -64,6 +144,43 @@ def find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment):
         return sess_data_file
  
        
+def read_dataset(dset):
+    """
+    Read the whole h5py dataset `dset` into a numpy array
+    Datasets stored as a single unfiltered chunk are read raw, bypassing the HDF5 selection/filter pipeline
+    """
+    if (dset.chunks is not None and dset.chunks == dset.shape and dset.dtype.kind not in 'OSUV'
+            and hasattr(dset.id, 'read_direct_chunk') and hasattr(dset.id, 'get_num_chunks')
+            and dset.id.get_num_chunks() == 1
+            and dset.id.get_create_plist().get_nfilters() == 0):
+        _, buf = dset.id.read_direct_chunk((0,) * dset.ndim)
+        return np.frombuffer(buf, dtype=dset.dtype).reshape(dset.shape)
+    return dset[()]
+
+
+def read_str(dset):
+    """
+    Read the (scalar or array) string dataset `dset` as str
+    Uses h5py's `asstr()` (h5py >= 3.0) to decode in bulk in the C layer, falling back to decoding in numpy
+    """
+    if hasattr(dset, 'asstr'):
+        value = dset.asstr()[()]
+        return value.astype(str) if isinstance(value, np.ndarray) else value
+    value = dset[()]
+    if isinstance(value, np.ndarray):
+        return np.char.decode(value, 'UTF-8') if value.dtype.kind == 'S' else value.astype(str)
+    return value.decode('UTF-8') if isinstance(value, bytes) else value
+
+
+def insert_in_chunks(table, rows, chunk_size=1024, **kwargs):
+    """
+    Insert `rows` into `table` in batches of `chunk_size` rows, passing `kwargs` on to `table.insert`
+    """
+    rows = list(rows)
+    for i in range(0, len(rows), chunk_size):
+        table.insert(rows[i:i + chunk_size], **kwargs)
+
+
 def get_brain_hemisphere(brain_region):
     # hemisphere: left-hemisphere is ipsi, so anything contra is right
     if re.search('Contra\s?', brain_region) is not None:
@@ -9,20 +9,27 @@ import re
 import pathlib
 import datajoint as dj
 
-import h5py as h5
 import numpy as np
 from decimal import Decimal
 
 from pipeline import (reference, subject, acquisition, stimulation, analysis,
                       intracellular, extracellular, behavior, utilities)
 
+# trial-tag patterns, compiled once for all trials of all files
+trial_id_re = re.compile('(\d+)')
+good_trial_re = re.compile('good', re.I)
+non_stim_re = re.compile('non-stimulation', re.I)
+trial_type_re = re.compile('Hit|Err|NoLick')
+trial_resp_re = re.compile('Hit|Err|NoLick|LickEarly')
+photo_stim_type_re = re.compile('PhotoStimulation|PhotoInhibition', re.I)
+
 # ================== Dataset ==================
 path = pathlib.Path(dj.config['custom'].get('extracellular_directory')).as_posix()
 fnames = os.listdir(path)
 
 for fname in fnames:
     try:
-        nwb = h5.File(os.path.join(path, fname), 'r')
+        nwb = utilities.open_nwbfile(os.path.join(path, fname))
         print(f'File loaded: {fname}')
     except:
         print('=================================')
@@ -32,7 +39,7 @@ for fname in fnames:
 
     # ========================== METADATA ==========================
     # ==================== Subject ====================
-    subject_info = {c: nwb['general']['subject'][c].value.decode('UTF-8')
+    subject_info = {c: utilities.read_str(nwb['general']['subject'][c])
                     for c in ('subject_id', 'description', 'sex', 'species', 'age', 'genotype')}
     # force subject_id to be lower-case for consistency
     subject_info['subject_id'] = subject_info['subject_id'].lower()
@@ -64,23 +71,23 @@ for fname in fnames:
 
     # ==================== session ====================
     # -- session_time
-    session_time = utilities.parse_prefix(nwb['session_start_time'].value)  # info here is incorrect (see identifier)
+    session_time = utilities.parse_prefix(utilities.read_str(nwb['session_start_time']))  # info here is incorrect (see identifier)
     # due to incorrect info in "session_start_time" - temporary fix: use info in 'identifier'
-    session_time = re.split(';\s?', nwb['identifier'].value)[-1].replace('T', ' ')
+    session_time = re.split(';\s?', utilities.read_str(nwb['identifier']))[-1].replace('T', ' ')
     session_time = utilities.parse_prefix(session_time)
 
     if session_time is not None:
         session_info = dict(
-            experiment_description=nwb['general']['experiment_description'].value,
-            institution=nwb['general']['institution'].value,
-            related_publications=nwb['general']['related_publications'].value.decode('UTF-8'),
-            surgery=nwb['general']['surgery'].value.decode('UTF-8'),
-            identifier=nwb['identifier'].value,
-            nwb_version=nwb['nwb_version'].value,
-            session_note=nwb['session_description'].value,
+            experiment_description=utilities.read_str(nwb['general']['experiment_description']),
+            institution=utilities.read_str(nwb['general']['institution']),
+            related_publications=utilities.read_str(nwb['general']['related_publications']),
+            surgery=utilities.read_str(nwb['general']['surgery']),
+            identifier=utilities.read_str(nwb['identifier']),
+            nwb_version=utilities.read_str(nwb['nwb_version']),
+            session_note=utilities.read_str(nwb['session_description']),
             session_time=session_time)
 
-        experimenters = nwb['general']['experimenter'].value
+        experimenters = utilities.read_str(nwb['general']['experimenter'])
         # experimenter and experiment type (possible multiple experimenters or types)
         experimenters = [experimenters] if np.array(
             experimenters).size <= 1 else experimenters  # in case there's only 1 experimenter
@@ -97,7 +104,7 @@ for fname in fnames:
             print(f'Creating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
 
     # ==================== Trials ====================
-    trial_key = {'subject_id': subject_info["subject_id"], 'session_time': session_info["session_time"]}
+    session_key = {'subject_id': subject_info["subject_id"], 'session_time': session_info["session_time"]}
     # map the hardcoded trial description (from 'reference.TrialType')
     trial_type_choices = {'L': 'lick left',
                           'R': 'lick right'}
@@ -110,80 +117,109 @@ for fname in fnames:
 
     # -- read trial-related info -- nwb['epochs'], nwb['analysis'], nwb['stimulus']['presentation'])
     cue_duration = 0.1  # hard-coded the fact that an auditory cue last 0.1 second
-    trial_details = dict(trial_names=[t for t in nwb['epochs']],
-                         tags=[nwb['epochs'][t]['tags'].value for t in nwb['epochs']],
-                         start_times=[nwb['epochs'][t]['start_time'].value for t in nwb['epochs']],
-                         stop_times=[nwb['epochs'][t]['stop_time'].value for t in nwb['epochs']],
-                         trial_type_string=np.array(nwb['analysis']['trial_type_string']),
-                         trial_type_mat=np.array(nwb['analysis']['trial_type_mat']),
-                         cue_start_times=np.array(nwb['stimulus']['presentation']['auditory_cue']['timestamps']),
-                         cue_end_times=np.array(nwb['stimulus']['presentation']['auditory_cue']['timestamps']) + cue_duration,  # hard-coded cue_end time here
-                         pole_in_times=np.array(nwb['stimulus']['presentation']['pole_in']['timestamps']),
-                         pole_out_times=np.array(nwb['stimulus']['presentation']['pole_out']['timestamps']))
-
+    trial_names = list(nwb['epochs'])
     # form new key-values pair and insert key
-    trial_key['trial_counts'] = len(trial_details['trial_names'])
+    trial_key = dict(session_key, trial_counts=len(trial_names))
     if trial_key not in acquisition.TrialSet.proj():
-        acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True)
-        print(f'Inserted trial set for: Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
-        print('Inserting trial ID: ', end="")
-        # loop through each trial and insert
-        for idx, trial_id in enumerate(trial_details['trial_names']):
-            trial_id = int(re.search('(\d+)', trial_id).group())
-            trial_key['trial_id'] = trial_id
-            # -- start/stop time
-            trial_key['start_time'] = trial_details['start_times'][idx]
-            trial_key['stop_time'] = trial_details['stop_times'][idx]
-            # ======== Now add trial descriptors ====
-            # search through all keyword in trial descriptor tags (keywords are not in fixed order)
-            tag_key = {}
-            tag_key['trial_is_good'] = False
-            tag_key['trial_stim_present'] = True
-            tag_key['trial_type'] = 'non-performing'
-            tag_key['trial_response'], tag_key['photo_stim_type'] = 'N/A', 'N/A'
-            for tag in trial_details['tags'][idx]:
-                # good/bad
-                if not tag_key['trial_is_good']:
-                    tag_key['trial_is_good'] = (re.match('good', tag, re.I) is not None)
-                # stim/no-stim
-                if tag_key['trial_stim_present']:
-                    tag_key['trial_stim_present'] = (re.match('non-stimulation', tag, re.I) is None)
-                # trial type: left/right lick
-                if tag_key['trial_type'] == 'non-performing':
-                    m = re.match('Hit|Err|NoLick', tag)
-                    tag_key['trial_type'] = 'non-performing' if (m is None) else trial_type_choices[tag[m.end()]]
-                # trial response type: correct, incorrect, early lick, no response
-                if tag_key['trial_response'] == 'N/A' or tag_key['trial_response'] != 'early lick':
-                    m = re.match('Hit|Err|NoLick|LickEarly', tag)
-                    if m: m.group()
-                    tag_key['trial_response'] = trial_resp_choices[m.group()] if m else tag_key['trial_response']
-                # photo stim type: stimulation, inhibition, or N/A (for non-stim trial)
-                if tag_key['photo_stim_type'] == 'N/A':
-                    m = re.match('PhotoStimulation|PhotoInhibition', tag, re.I)
-                    tag_key['photo_stim_type'] = 'N/A' if (m is None) else m.group().replace('Photo','').lower()
-            # insert
-            acquisition.TrialSet.Trial.insert1({**trial_key, **tag_key},
-                                               ignore_extra_fields=True, allow_direct_insert=True)
-            # ======== Now add trial event timing to the TrialInfo part table ====
-            # -- events timing
-            acquisition.TrialSet.EventTime.insert((dict(trial_key, trial_event=k, event_time=trial_details[e][idx])
-                                                    for k, e in zip(('trial_start', 'trial_stop', 'cue_start',
-                                                                     'cue_end', 'pole_in', 'pole_out'),
-                                                                    ('start_times', 'stop_times', 'cue_start_times',
-                                                                     'cue_end_times', 'pole_in_times', 'pole_out_times'))),
-                                                   ignore_extra_fields=True, allow_direct_insert=True)
+        # resolve each epoch group once, rather than walking nwb['epochs'] again for every field
+        epochs = [nwb['epochs'][t] for t in trial_names]
+        # read the per-trial event timestamps straight into one preallocated (event x trial) buffer
+        event_times = np.empty((4, len(trial_names)), dtype=np.float64)
+        short_events = []
+        for event_idx, event in ((0, 'auditory_cue'), (2, 'pole_in'), (3, 'pole_out')):
+            timestamps = nwb['stimulus']['presentation'][event]['timestamps']
+            if timestamps.size < len(trial_names):
+                short_events.append(event)
+            elif timestamps.ndim == 1:
+                timestamps.read_direct(event_times[event_idx], np.s_[:len(trial_names)])
+            else:  # e.g. (n, 1) shaped timestamps
+                event_times[event_idx] = timestamps[()].ravel()[:len(trial_names)]
+        np.add(event_times[0], cue_duration, out=event_times[1])  # hard-coded cue_end time here
+        trial_details = dict(trial_names=trial_names,
+                             tags=[utilities.read_str(e['tags']) for e in epochs],
+                             start_times=np.array([e['start_time'][()] for e in epochs]),
+                             stop_times=np.array([e['stop_time'][()] for e in epochs]),
+                             trial_type_mat=nwb['analysis']['trial_type_mat'][()],
+                             cue_start_times=event_times[0],
+                             cue_end_times=event_times[1],
+                             pole_in_times=event_times[2],
+                             pole_out_times=event_times[3])
+
+        if short_events:
+            print('=================================')
+            print(f'!!! SKIPPING TRIAL SET OF FILE: {fname} - fewer {", ".join(short_events)} timestamps than trials ({len(trial_names)})')
+            print('=================================')
+        else:
+            print('Inserting trial ID: ', end="")
+            trials, trial_events, trial_photostims = [], [], []
+            # photostim descriptors are the last 5 rows of trial_type_mat - take row views once, outside the loop
+            photostim_periods, photostim_powers, galvo_x, galvo_y, galvo_z = trial_details['trial_type_mat'][-5:]
+            # loop through each trial and collect the rows to insert
+            for idx, trial_id in enumerate(trial_details['trial_names']):
+                trial_id = int(trial_id_re.search(trial_id).group())
+                trial_id_key = dict(session_key, trial_id=trial_id)
+                # ======== Now add trial descriptors ====
+                # search through all keyword in trial descriptor tags (keywords are not in fixed order)
+                tag_key = {}
+                tag_key['trial_is_good'] = False
+                tag_key['trial_stim_present'] = True
+                tag_key['trial_type'] = 'non-performing'
+                tag_key['trial_response'], tag_key['photo_stim_type'] = 'N/A', 'N/A'
+                for tag in trial_details['tags'][idx]:
+                    # good/bad
+                    if not tag_key['trial_is_good']:
+                        tag_key['trial_is_good'] = (good_trial_re.match(tag) is not None)
+                    # stim/no-stim
+                    if tag_key['trial_stim_present']:
+                        tag_key['trial_stim_present'] = (non_stim_re.match(tag) is None)
+                    # trial type: left/right lick
+                    if tag_key['trial_type'] == 'non-performing':
+                        m = trial_type_re.match(tag)
+                        tag_key['trial_type'] = 'non-performing' if (m is None) else trial_type_choices[tag[m.end()]]
+                    # trial response type: correct, incorrect, early lick, no response
+                    if tag_key['trial_response'] == 'N/A' or tag_key['trial_response'] != 'early lick':
+                        m = trial_resp_re.match(tag)
+                        tag_key['trial_response'] = trial_resp_choices[m.group()] if m else tag_key['trial_response']
+                    # photo stim type: stimulation, inhibition, or N/A (for non-stim trial)
+                    if tag_key['photo_stim_type'] == 'N/A':
+                        m = photo_stim_type_re.match(tag)
+                        tag_key['photo_stim_type'] = 'N/A' if (m is None) else m.group().replace('Photo','').lower()
+                trials.append(dict(trial_id_key,
+                                   start_time=trial_details['start_times'][idx],
+                                   stop_time=trial_details['stop_times'][idx],
+                                   trial_is_good=tag_key['trial_is_good'],
+                                   trial_stim_present=tag_key['trial_stim_present'],
+                                   trial_type=tag_key['trial_type'],
+                                   trial_response=tag_key['trial_response']))
+                # ======== Now add trial event timing to the TrialInfo part table ====
+                # -- events timing
+                trial_events.extend(dict(trial_id_key, trial_event=k, event_time=trial_details[e][idx])
+                                   for k, e in zip(('trial_start', 'trial_stop', 'cue_start',
+                                                    'cue_end', 'pole_in', 'pole_out'),
+                                                   ('start_times', 'stop_times', 'cue_start_times',
+                                                    'cue_end_times', 'pole_in_times', 'pole_out_times')))
 
-            # ======== Now add trial stimulation descriptors to the TrialPhotoStimInfo table ====
-            trial_key['photo_stim_period'] = ('N/A' if trial_details['trial_type_mat'][-5, idx] == 0
-                                              else photostim_period_choices[trial_details['trial_type_mat'][-5, idx]])
-            trial_key['photo_stim_power'] = trial_details['trial_type_mat'][-4, idx]
-            trial_key['photo_loc_galvo_x'] = trial_details['trial_type_mat'][-3, idx]
-            trial_key['photo_loc_galvo_y'] = trial_details['trial_type_mat'][-2, idx]
-            trial_key['photo_loc_galvo_z'] = trial_details['trial_type_mat'][-1, idx]
-            # insert
-            stimulation.TrialPhotoStimInfo.insert1(trial_key, ignore_extra_fields=True, allow_direct_insert=True)
-            print(f'{trial_id} ', end="")
-        print('')
+                # ======== Now add trial stimulation descriptors to the TrialPhotoStimInfo table ====
+                trial_photostims.append(dict(trial_id_key,
+                                             photo_stim_type=tag_key['photo_stim_type'],
+                                             photo_stim_period=('N/A' if photostim_periods[idx] == 0
+                                                                else photostim_period_choices[photostim_periods[idx]]),
+                                             photo_stim_power=photostim_powers[idx],
+                                             photo_loc_galvo_x=galvo_x[idx],
+                                             photo_loc_galvo_y=galvo_y[idx],
+                                             photo_loc_galvo_z=galvo_z[idx]))
+                print(f'{trial_id} ', end="")
+            print('')
+            # insert the trial set and all of its trials atomically
+            with acquisition.TrialSet.connection.transaction:
+                acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True)
+                utilities.insert_in_chunks(acquisition.TrialSet.Trial, trials,
+                                           skip_duplicates=True, allow_direct_insert=True)
+                utilities.insert_in_chunks(acquisition.TrialSet.EventTime, trial_events,
+                                           skip_duplicates=True, allow_direct_insert=True)
+                utilities.insert_in_chunks(stimulation.TrialPhotoStimInfo, trial_photostims,
+                                           skip_duplicates=True, allow_direct_insert=True)
+            print(f'Inserted trial set for: Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
 
     # ==================== Extracellular ====================
     # -- read data - devices
@@ -216,7 +252,7 @@ for fname in fnames:
     if brain_location not in reference.BrainLocation.proj():
         reference.BrainLocation.insert1(brain_location)
     # -- ActionLocation
-    ground_coordinates = nwb['general']['extracellular_ephys']['ground_coordinates'].value  # using 'ground_coordinates' here as the x, y, z for where the probe is placed in the brain, TODO double check if this is correct
+    ground_coordinates = nwb['general']['extracellular_ephys']['ground_coordinates'][()]  # using 'ground_coordinates' here as the x, y, z for where the probe is placed in the brain, TODO double check if this is correct
     action_location = dict(brain_location,
                            coordinate_ref='bregma',
                            coordinate_ap=round(Decimal(str(ground_coordinates[0])), 2),
@@ -238,10 +274,10 @@ for fname in fnames:
 
     # -- read data - optogenetics
     opto_site_name = list(nwb['general']['optogenetics'].keys())[0]
-    opto_descs = nwb['general']['optogenetics'][opto_site_name]['description'].value.decode('UTF-8')
-    opto_excitation_lambda = nwb['general']['optogenetics'][opto_site_name]['excitation_lambda'].value.decode('UTF-8')
-    opto_location = nwb['general']['optogenetics'][opto_site_name]['location'].value.decode('UTF-8')
-    opto_stimulation_method = nwb['general']['optogenetics'][opto_site_name]['stimulation_method'].value.decode('UTF-8')
+    opto_descs = utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['description'])
+    opto_excitation_lambda = utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['excitation_lambda'])
+    opto_location = utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['location'])
+    opto_stimulation_method = utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['stimulation_method'])
 
     brain_region = re.search('(?<=atlas location:\s)(.*)', opto_location).group()
     
@@ -284,8 +320,8 @@ for fname in fnames:
         if dict({**subject_info, **session_info},
                 photostim_datetime = session_info['session_time']) not in stimulation.PhotoStimulation.proj():
             # only 1 photostim per session, perform at the same time with session
-            photostim_data = nwb['stimulus']['presentation']['photostimulus_1']['data'].value
-            photostim_timestamps = nwb['stimulus']['presentation']['photostimulus_1']['timestamps'].value
+            photostim_data = nwb['stimulus']['presentation']['photostimulus_1']['data'][()]
+            photostim_timestamps = nwb['stimulus']['presentation']['photostimulus_1']['timestamps'][()]
             # if the dataset does not contain photostim timeseries set to None
             photostim_data = None if not isinstance(photostim_data, np.ndarray) else photostim_data
             photostim_timestamps = None if not isinstance(photostim_timestamps, np.ndarray) else photostim_timestamps
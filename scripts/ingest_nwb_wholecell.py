@@ -7,7 +7,6 @@ Created on Mon Dec  3 16:22:42 2018
 import os
 import re
 import pathlib
-import h5py as h5
 import numpy as np
 from decimal import Decimal
 import datajoint as dj
@@ -15,6 +14,9 @@ import datajoint as dj
 from pipeline import (reference, subject, acquisition, stimulation, analysis,
                       intracellular, extracellular, behavior, utilities)
 
+trial_id_re = re.compile('\d+')
+# trial responses (from 'reference.TrialResponse'), indexed by the response codes assigned below
+trial_response_labels = np.array(['correct', 'incorrect', 'no response', 'early lick', 'N/A'])
 
 # ================== Dataset ==================
 path = pathlib.Path(dj.config['custom'].get('intracellular_directory')).as_posix()
@@ -22,7 +24,7 @@ fnames = os.listdir(path)
 
 for fname in fnames:
     try:
-        nwb = h5.File(os.path.join(path, fname), 'r')
+        nwb = utilities.open_nwbfile(os.path.join(path, fname))
         print(f'File loaded: {fname}')
     except:
         print('=================================')
@@ -32,7 +34,7 @@ for fname in fnames:
     
     # ========================== METADATA ==========================
     # ==================== subject ====================
-    subject_info = {c: nwb['general']['subject'][c].value.decode('UTF-8')
+    subject_info = {c: utilities.read_str(nwb['general']['subject'][c])
                     for c in ('subject_id', 'description', 'sex', 'species', 'weight', 'age', 'genotype')}
     # force subject_id to be lower-case for consistency
     subject_info['subject_id'] = subject_info['subject_id'].lower()
@@ -62,20 +64,20 @@ for fname in fnames:
 
     # ==================== session ====================
     # -- session_time
-    session_time = utilities.parse_prefix(nwb['session_start_time'].value)
+    session_time = utilities.parse_prefix(utilities.read_str(nwb['session_start_time']))
     if session_time is not None:
         session_info = dict(
-            experiment_description=nwb['general']['experiment_description'].value,
-            institution=nwb['general']['institution'].value,
-            related_publications=nwb['general']['related_publications'].value.decode('UTF-8'),
-            session_id=nwb['general']['session_id'].value,
-            surgery=nwb['general']['surgery'].value.decode('UTF-8'),
-            identifier=nwb['identifier'].value,
-            nwb_version=nwb['nwb_version'].value,
-            session_note=nwb['session_description'].value,
+            experiment_description=utilities.read_str(nwb['general']['experiment_description']),
+            institution=utilities.read_str(nwb['general']['institution']),
+            related_publications=utilities.read_str(nwb['general']['related_publications']),
+            session_id=utilities.read_str(nwb['general']['session_id']),
+            surgery=utilities.read_str(nwb['general']['surgery']),
+            identifier=utilities.read_str(nwb['identifier']),
+            nwb_version=utilities.read_str(nwb['nwb_version']),
+            session_note=utilities.read_str(nwb['session_description']),
             session_time=session_time)
 
-        experimenters = nwb['general']['experimenter'].value
+        experimenters = utilities.read_str(nwb['general']['experimenter'])
         experiment_types = re.split('Experiment type: ', session_info['session_note'])[-1]
         experiment_types = re.split(',\s?', experiment_types)
 
@@ -93,78 +95,90 @@ for fname in fnames:
             print(f'Creating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
 
     # ==================== Trials ====================
-    trial_key = {'subject_id': subject_info["subject_id"], 'session_time': session_info["session_time"]}
+    session_key = {'subject_id': subject_info["subject_id"], 'session_time': session_info["session_time"]}
     # -- read trial-related info -- nwb['epochs'], nwb['analysis'], nwb['stimulus']['presentation'])
-    trial_details = dict(trial_names=[tr for tr in nwb['epochs']],
-                         trial_descs=[v['description'].value for v in nwb['epochs'].values()],
-                         start_times=[v['start_time'].value for v in nwb['epochs'].values()],
-                         stop_times=[v['stop_time'].value for v in nwb['epochs'].values()],
-                         good_trials=nwb['analysis']['good_trials'].value,
-                         trial_type_string=nwb['analysis']['trial_type_string'].value,
-                         trial_type_mat=nwb['analysis']['trial_type_mat'].value,
-                         cue_start_times=nwb['stimulus']['presentation']['cue_start']['timestamps'].value,
-                         cue_end_times=nwb['stimulus']['presentation']['cue_end']['timestamps'].value,
-                         pole_in_times=nwb['stimulus']['presentation']['pole_in']['timestamps'].value,
-                         pole_out_times=nwb['stimulus']['presentation']['pole_out']['timestamps'].value)
-
+    trial_names = list(nwb['epochs'])
     # form new key-values pair and insert key
-    trial_key['trial_counts'] = len(trial_details['trial_names'])
-
+    trial_key = dict(session_key, trial_counts=len(trial_names))
     if trial_key not in acquisition.TrialSet.proj():
-        acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True)
-        print(f'Inserted trial set for: Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
-        print('Inserting trial ID: ', end="")
-        # loop through each trial and insert
-        for idx, trial_id in enumerate(trial_details['trial_names']):
-            trial_id = int(re.search('\d+', trial_id).group())
-            trial_key['trial_id'] = trial_id
-            # -- start/stop time
-            trial_key['start_time'] = trial_details['start_times'][idx]
-            trial_key['stop_time'] = trial_details['stop_times'][idx]
-            # ======== Now add trial descriptors ====
-            # -- good/bad trial_status (nwb['analysis']['good_trials'])
-            trial_key['trial_is_good'] = True if trial_details['good_trials'].flatten()[idx] == 1 else False
-            trial_code = trial_details['trial_type_mat'][idx]
+        # resolve each epoch group once, rather than walking nwb['epochs'] again for every field
+        epochs = [nwb['epochs'][tr] for tr in trial_names]
+        # read the per-trial event timestamps straight into one preallocated (event x trial) buffer
+        event_times = np.empty((4, len(trial_names)), dtype=np.float64)
+        short_events = []
+        for event_idx, event in enumerate(('cue_start', 'cue_end', 'pole_in', 'pole_out')):
+            timestamps = nwb['stimulus']['presentation'][event]['timestamps']
+            if timestamps.size < len(trial_names):
+                short_events.append(event)
+            elif timestamps.ndim == 1:
+                timestamps.read_direct(event_times[event_idx], np.s_[:len(trial_names)])
+            else:  # e.g. (n, 1) shaped timestamps
+                event_times[event_idx] = timestamps[()].ravel()[:len(trial_names)]
+        trial_details = dict(trial_names=trial_names,
+                             start_times=np.array([e['start_time'][()] for e in epochs]),
+                             stop_times=np.array([e['stop_time'][()] for e in epochs]),
+                             good_trials=nwb['analysis']['good_trials'][()].ravel() == 1,
+                             trial_type_mat=nwb['analysis']['trial_type_mat'][()],
+                             cue_start_times=event_times[0],
+                             cue_end_times=event_times[1],
+                             pole_in_times=event_times[2],
+                             pole_out_times=event_times[3])
 
+        if short_events:
+            print('=================================')
+            print(f'!!! SKIPPING TRIAL SET OF FILE: {fname} - fewer {", ".join(short_events)} timestamps than trials ({len(trial_names)})')
+            print('=================================')
+        else:
+            # classify all trials at once from the trial-type matrix (one row per trial)
+            trial_ids = [int(trial_id_re.search(trial_name).group()) for trial_name in trial_details['trial_names']]
+            trial_code = np.asarray(trial_details['trial_type_mat']) != 0
             # -- trial type --
-            if trial_code[1] or trial_code[3]:
-                trial_key['trial_type'] = 'lick left'
-            elif trial_code[0] or trial_code[2]:
-                trial_key['trial_type'] = 'lick right'
-            else:
-                trial_key['trial_type'] = 'non-performing'
-            # -- trial response --
-            if trial_code[4]:
-                trial_key['trial_response'] = 'early lick'
-            elif trial_code[0] or trial_code[1]:
-                trial_key['trial_response'] = 'correct'
-            elif trial_code[2] or trial_code[3]:
-                trial_key['trial_response'] = 'incorrect'
-            elif trial_code[5]:
-                trial_key['trial_response'] = 'no response'
+            trial_types = np.select([trial_code[:, 1] | trial_code[:, 3], trial_code[:, 0] | trial_code[:, 2]],
+                                    ['lick left', 'lick right'], default='non-performing')
+            # -- trial response -- (assigned in increasing precedence: early lick overrides all)
+            response_codes = np.full(len(trial_code), 4, dtype=np.uint8)
+            response_codes[trial_code[:, 5]] = 2
+            response_codes[trial_code[:, 2] | trial_code[:, 3]] = 1
+            response_codes[trial_code[:, 0] | trial_code[:, 1]] = 0
+            response_codes[trial_code[:, 4]] = 3
+            trial_responses = trial_response_labels[response_codes]
             # -- trial stim --
-            trial_key['trial_stim_present'] = bool(trial_code[-1])
-            # insert
-            acquisition.TrialSet.Trial.insert1(trial_key, ignore_extra_fields=True, skip_duplicates=True, allow_direct_insert=True)
+            trial_stim_present = trial_code[:, -1]
+
+            trials = [dict(session_key, trial_id=trial_id,
+                           start_time=trial_details['start_times'][idx],
+                           stop_time=trial_details['stop_times'][idx],
+                           trial_is_good=bool(trial_details['good_trials'][idx]),
+                           trial_type=trial_types[idx],
+                           trial_response=trial_responses[idx],
+                           trial_stim_present=bool(trial_stim_present[idx]))
+                      for idx, trial_id in enumerate(trial_ids)]
             # ======== Now add trial event timing to the EventTime part table ====
             # -- events timing
-            acquisition.TrialSet.EventTime.insert((dict(trial_key, trial_event=k, event_time = trial_details[e][idx])
-                                                    for k, e in zip(('trial_start', 'trial_stop', 'cue_start',
-                                                                     'cue_end', 'pole_in', 'pole_out'),
-                                                                    ('start_times', 'stop_times', 'cue_start_times',
-                                                                     'cue_end_times', 'pole_in_times', 'pole_out_times'))),
-                                                   ignore_extra_fields=True, allow_direct_insert=True)
-            print(f'{trial_id} ', end="")
-        print('')
+            trial_events = [dict(session_key, trial_id=trial_id, trial_event=k, event_time=trial_details[e][idx])
+                            for idx, trial_id in enumerate(trial_ids)
+                            for k, e in zip(('trial_start', 'trial_stop', 'cue_start',
+                                             'cue_end', 'pole_in', 'pole_out'),
+                                            ('start_times', 'stop_times', 'cue_start_times',
+                                             'cue_end_times', 'pole_in_times', 'pole_out_times'))]
+            # insert the trial set and all of its trials atomically
+            with acquisition.TrialSet.connection.transaction:
+                acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True)
+                utilities.insert_in_chunks(acquisition.TrialSet.Trial, trials,
+                                           skip_duplicates=True, allow_direct_insert=True)
+                utilities.insert_in_chunks(acquisition.TrialSet.EventTime, trial_events,
+                                           skip_duplicates=True, allow_direct_insert=True)
+            print(f'Inserted trial set for: Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
+            print('Inserted trial ID: ' + ' '.join(str(trial_id) for trial_id in trial_ids))
 
     # ==================== Intracellular ====================
     # -- read data - devices
-    devices = {d: nwb['general']['devices'][d].value.decode('UTF-8') for d in nwb['general']['devices']}
+    devices = {d: utilities.read_str(nwb['general']['devices'][d]) for d in nwb['general']['devices']}
         
     # -- read data - intracellular_ephys
-    ie_filtering = nwb['general']['intracellular_ephys']['whole_cell']['filtering'].value
+    ie_filtering = utilities.read_str(nwb['general']['intracellular_ephys']['whole_cell']['filtering'])
 
-    ie_location = nwb['general']['intracellular_ephys']['whole_cell']['location'].value
+    ie_location = utilities.read_str(nwb['general']['intracellular_ephys']['whole_cell']['location'])
     brain_region = re.split(',\s?', ie_location)[-1]
     coord_ap_ml_dv = re.findall('\d+.\d+', ie_location)
     
@@ -187,7 +201,7 @@ for fname in fnames:
         reference.ActionLocation.insert1(action_location)
     
     # -- Whole Cell Device
-    ie_device = nwb['general']['intracellular_ephys']['whole_cell']['device'].value
+    ie_device = utilities.read_str(nwb['general']['intracellular_ephys']['whole_cell']['device'])
     if {'device_name': ie_device} not in reference.WholeCellDevice.proj():
         reference.WholeCellDevice.insert1({'device_name': ie_device, 'device_desc': devices[ie_device]})
     
@@ -203,11 +217,10 @@ for fname in fnames:
     # ==================== Photo stimulation ====================    
     # -- read data - optogenetics
     opto_site_name = list(nwb['general']['optogenetics'].keys())[0]
-    opto_descs = nwb['general']['optogenetics'][opto_site_name]['description'].value.decode('UTF-8')
+    opto_descs = utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['description'])
     opto_excitation_lambda = (re.search("\d+",
-                                        nwb['general']['optogenetics'][opto_site_name]['excitation_lambda']
-                                        .value.decode('UTF-8')).group())
-    splittedstr = re.split(',\s?coordinates:\s?', nwb['general']['optogenetics'][opto_site_name]['location'].value.decode('UTF-8'))
+                                        utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['excitation_lambda'])).group())
+    splittedstr = re.split(',\s?coordinates:\s?', utilities.read_str(nwb['general']['optogenetics'][opto_site_name]['location']))
     brain_region = splittedstr[0]
     coord_ap_ml_dv = re.findall('\d+\.\d+', splittedstr[-1])
     
@@ -246,8 +259,8 @@ for fname in fnames:
     # only 1 photostim per session, perform at the same time with session
     if dict({**subject_info, **session_info}, 
             photostim_datetime=session_info['session_time']) not in stimulation.PhotoStimulation.proj():
-        photostim_data = nwb['stimulus']['presentation']['photostimulus']['data'].value
-        photostim_timestamps = nwb['stimulus']['presentation']['photostimulus']['timestamps'].value
+        photostim_data = nwb['stimulus']['presentation']['photostimulus']['data'][()]
+        photostim_timestamps = nwb['stimulus']['presentation']['photostimulus']['timestamps'][()]
         stimulation.PhotoStimulation.insert1(dict({**subject_info, **session_info, **photim_stim_info},
                                                   photostim_datetime=session_info['session_time'],
                                                   photostim_timeseries=photostim_data,
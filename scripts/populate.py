@@ -1,24 +1,49 @@
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+import inspect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import datajoint as dj
 
 from pipeline import intracellular, extracellular, analysis, behavior, stimulation
 
 
 settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False}
+n_workers = dj.config['custom'].get('populate.n_workers', 8)
+
+
+def _populate_worker(table):
+    # spawned worker - re-imports the pipeline, hence opens its own database connection (and its own NWB files)
+    table.populate(**settings)
+
+
+def populate_parallel(table, n_workers=n_workers):
+    """
+    Populate `table` with `n_workers` processes - jobs are distributed through datajoint's job reservation
+    """
+    if 'processes' in inspect.signature(table.populate).parameters:
+        table.populate(processes=n_workers, **settings)
+        return
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for f in [executor.submit(_populate_worker, table) for _ in range(n_workers)]:
+            f.result()
+
+
+if __name__ == '__main__':
+    # ============= Extracellular =============
+    # -- Ingest unit spike times
+    populate_parallel(extracellular.UnitSpikeTimes)
+    # -- UnitSpikeTimes trial-segmentation
+    analysis.RealignedEvent.populate(**settings)
+    extracellular.TrialSegmentedUnitSpikeTimes.populate(**settings)
 
-# ============= Extracellular =============
-# -- Ingest unit spike times
-extracellular.UnitSpikeTimes.populate(**settings)
-# -- UnitSpikeTimes trial-segmentation
-analysis.RealignedEvent.populate(**settings)
-extracellular.TrialSegmentedUnitSpikeTimes.populate(**settings)
-
-# ============= Intracellular =============
-intracellular.MembranePotential.populate(**settings)
-intracellular.CurrentInjection.populate(**settings)
-# -- Behavioral
-behavior.LickTrace.populate(**settings)
-# -- Perform trial segmentation
-intracellular.TrialSegmentedMembranePotential.populate(**settings)
-intracellular.TrialSegmentedCurrentInjection.populate(**settings)
-stimulation.TrialSegmentedPhotoStimulus.populate(**settings)
+    # ============= Intracellular =============
+    populate_parallel(intracellular.MembranePotential)
+    populate_parallel(intracellular.CurrentInjection)
+    # -- Behavioral
+    populate_parallel(behavior.LickTrace)
+    # -- Perform trial segmentation
+    intracellular.TrialSegmentedMembranePotential.populate(**settings)
+    intracellular.TrialSegmentedCurrentInjection.populate(**settings)
+    stimulation.TrialSegmentedPhotoStimulus.populate(**settings)